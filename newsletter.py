@@ -8,106 +8,168 @@ Daily Telecom Newsletter Generator v5
 """
  
 import os
-import json
+import re
 import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import feedparser
+import orjson
 import anthropic
 import smtplib
+import threading
 import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from urllib.parse import urljoin, urlparse
+from urllib.parse import urljoin, urlparse, urlunparse
 from collections import defaultdict
+from html import escape
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import base64
+import calendar
+import hashlib
+import gzip
  
  
 # ─────────────────────────────────────────────
 # 0. SEEN URLs — persist via GitHub API
 # ─────────────────────────────────────────────
  
-SEEN_URLS_FILE = "seen_urls.txt"
+SEEN_URLS_FILE        = "seen_urls.txt.gz"   # gzip: the URL list is mostly repeated prefixes
+SEEN_URLS_LEGACY_FILE = "seen_urls.txt"      # uncompressed predecessor, read until the first save
 SEEN_URLS_EXPIRY_DAYS = 7
  
-def load_seen_urls(github_token: str, github_repo: str) -> tuple[set, str]:
-    """Load seen URLs. Format per line: url|||YYYY-MM-DD
+def load_seen_urls(github_token: str, github_repo: str) -> tuple[dict, str]:
+    """Load seen URLs as {url: first_seen_date}. Format per line: url|||YYYY-MM-DD
     Entries older than SEEN_URLS_EXPIRY_DAYS are discarded automatically."""
     if not github_token or not github_repo:
-        return set(), ""
+        return {}, ""
     try:
-        api_url = f"https://api.github.com/repos/{github_repo}/contents/{SEEN_URLS_FILE}"
-        r = requests.get(api_url, headers={"Authorization": f"token {github_token}"}, timeout=10)
+        api_url = f"https://api.github.com/repos/{github_repo}/contents/"
+        headers = {"Authorization": f"token {github_token}"}
+        r = SESSION.get(api_url + SEEN_URLS_FILE, headers=headers, timeout=10)
         if r.status_code == 404:
-            print("  seen_urls.txt nao existe ainda, a criar...")
-            return set(), ""
-        r.raise_for_status()
-        data = r.json()
-        sha = data.get("sha", "")
-        decoded = base64.b64decode(data["content"]).decode("utf-8")
-        cutoff = datetime.date.today() - datetime.timedelta(days=SEEN_URLS_EXPIRY_DAYS)
-        urls = set()
+            # Not migrated yet: read the old plain-text file; the first save writes the .gz
+            r = SESSION.get(api_url + SEEN_URLS_LEGACY_FILE, headers=headers, timeout=10)
+            if r.status_code == 404:
+                print(f"  {SEEN_URLS_FILE} nao existe ainda, a criar...")
+                return {}, ""
+            r.raise_for_status()
+            print(f"  {SEEN_URLS_FILE} nao existe ainda, a migrar de {SEEN_URLS_LEGACY_FILE}...")
+            sha = ""
+            raw = base64.b64decode(r.json()["content"])
+        else:
+            r.raise_for_status()
+            data = r.json()
+            sha = data.get("sha", "")
+            raw = gzip.decompress(base64.b64decode(data["content"]))
+        today_str = datetime.date.today().isoformat()
+        cutoff = (datetime.date.today() - datetime.timedelta(days=SEEN_URLS_EXPIRY_DAYS)).isoformat()
+        urls = {}
         expired = 0
-        for line in decoded.splitlines():
+        # Split in bytes: only the URLs that are kept get decoded
+        for line in raw.split(b"\n"):
             line = line.strip()
             if not line:
                 continue
-            if "|||" in line:
-                url_part, date_str = line.rsplit("|||", 1)
-                try:
-                    if datetime.date.fromisoformat(date_str) >= cutoff:
-                        urls.add(url_part.strip())
-                    else:
-                        expired += 1
-                except ValueError:
-                    urls.add(url_part.strip())
+            url_part, sep, date_part = line.rpartition(b"|||")
+            if not sep:
+                urls[line.decode("utf-8")] = today_str
+                continue
+            try:
+                # Real calendar check (rejects e.g. 2024-13-45); only 10 bytes per line
+                date_str = datetime.date.fromisoformat(date_part.decode("ascii")).isoformat()
+            except ValueError:
+                urls[url_part.strip().decode("utf-8")] = today_str
+                continue
+            if date_str >= cutoff:
+                urls[url_part.strip().decode("utf-8")] = date_str
             else:
-                urls.add(line)
+                expired += 1
         print(f"  {len(urls)} URLs validos carregados, {expired} expirados removidos")
         return urls, sha
     except Exception as e:
-        print(f"[WARN] Nao foi possivel carregar seen_urls.txt: {e}")
-        return set(), ""
+        print(f"[WARN] Nao foi possivel carregar {SEEN_URLS_FILE}: {e}")
+        return {}, ""
  
  
-def save_seen_urls(github_token: str, github_repo: str, existing_urls: set, new_urls: set, sha: str):
-    """Save seen URLs. New URLs get today's date; existing keep their original date."""
+def save_seen_urls(github_token: str, github_repo: str, existing_urls: dict, new_urls: set, sha: str):
+    """Save seen URLs. New URLs get today's date; existing keep their original date.
+    existing_urls is the {url: date} mapping from load_seen_urls, so no second download."""
     if not github_token or not github_repo:
         return
     try:
         today_str = datetime.date.today().isoformat()
-        cutoff = datetime.date.today() - datetime.timedelta(days=SEEN_URLS_EXPIRY_DAYS)
         api_url = f"https://api.github.com/repos/{github_repo}/contents/{SEEN_URLS_FILE}"
-        # Reload existing lines to preserve original dates
-        dated = {}
-        r = requests.get(api_url, headers={"Authorization": f"token {github_token}"}, timeout=10)
-        if r.status_code == 200:
-            decoded = base64.b64decode(r.json()["content"]).decode("utf-8")
-            for line in decoded.splitlines():
-                line = line.strip()
-                if not line:
-                    continue
-                if "|||" in line:
-                    url_part, date_str = line.rsplit("|||", 1)
-                    try:
-                        if datetime.date.fromisoformat(date_str) >= cutoff:
-                            dated[url_part.strip()] = date_str
-                    except ValueError:
-                        dated[url_part.strip()] = today_str
-                else:
-                    dated[line] = today_str
+        dated = dict(existing_urls)
         for url in new_urls:
             dated[url] = today_str
         lines = [f"{url}|||{date}" for url, date in sorted(dated.items())]
-        encoded = base64.b64encode("\n".join(lines).encode("utf-8")).decode("utf-8")
-        payload = {"message": "chore: update seen_urls.txt", "content": encoded}
+        # mtime=0: unchanged content gives an identical blob, so no spurious diff
+        compressed = gzip.compress("\n".join(lines).encode("utf-8"), compresslevel=6, mtime=0)
+        encoded = base64.b64encode(compressed).decode("utf-8")
+        payload = {"message": f"chore: update {SEEN_URLS_FILE}", "content": encoded}
+        if sha:
+            payload["sha"] = sha
+        r = SESSION.put(api_url, json=payload,
+                        headers={"Authorization": f"token {github_token}"}, timeout=15)
+        r.raise_for_status()
+        print(f"  {SEEN_URLS_FILE} actualizado ({len(dated)} URLs, expiram ao fim de {SEEN_URLS_EXPIRY_DAYS} dias)")
+    except Exception as e:
+        print(f"[WARN] Nao foi possivel guardar {SEEN_URLS_FILE}: {e}")
+ 
+ 
+FEED_CACHE_FILE           = "feed_cache.json"      # {feed_url: {"etag": ..., "last_modified": ...}}
+SUMMARY_CACHE_FILE        = "summary_cache.json"   # {article_hash: {"title", "summary", "date"}}
+SUMMARY_CACHE_EXPIRY_DAYS = 14
+ 
+def load_json_state(github_token: str, github_repo: str, path: str) -> tuple[dict, str]:
+    """Load a JSON object stored in the repo. Returns ({}, "") if missing or unavailable."""
+    if not github_token or not github_repo:
+        return {}, ""
+    try:
+        api_url = f"https://api.github.com/repos/{github_repo}/contents/{path}"
+        r = SESSION.get(api_url, headers={"Authorization": f"token {github_token}"}, timeout=10)
+        if r.status_code == 404:
+            print(f"  {path} nao existe ainda, a criar...")
+            return {}, ""
+        r.raise_for_status()
+        data = r.json()
+        raw = base64.b64decode(data["content"])
+        state = orjson.loads(raw)   # parses the UTF-8 bytes directly, no decode step
+        print(f"  {path}: {len(state)} entradas carregadas")
+        return state, data.get("sha", "")
+    except Exception as e:
+        print(f"[WARN] Nao foi possivel carregar {path}: {e}")
+        return {}, ""
+ 
+ 
+def save_json_state(github_token: str, github_repo: str, path: str, state: dict, sha: str):
+    if not github_token or not github_repo:
+        return
+    try:
+        api_url = f"https://api.github.com/repos/{github_repo}/contents/{path}"
+        content = orjson.dumps(state, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+        encoded = base64.b64encode(content).decode("utf-8")
+        payload = {"message": f"chore: update {path}", "content": encoded}
         if sha:
             payload["sha"] = sha
-        r = requests.put(api_url, json=payload,
-                         headers={"Authorization": f"token {github_token}"}, timeout=15)
+        r = SESSION.put(api_url, json=payload,
+                        headers={"Authorization": f"token {github_token}"}, timeout=15)
         r.raise_for_status()
-        print(f"  seen_urls.txt actualizado ({len(dated)} URLs, expiram ao fim de {SEEN_URLS_EXPIRY_DAYS} dias)")
+        print(f"  {path} actualizado ({len(state)} entradas)")
     except Exception as e:
-        print(f"[WARN] Nao foi possivel guardar seen_urls.txt: {e}")
+        print(f"[WARN] Nao foi possivel guardar {path}: {e}")
+ 
+ 
+def load_summary_cache(github_token: str, github_repo: str) -> tuple[dict, str]:
+    """Load cached Claude summaries, discarding those older than SUMMARY_CACHE_EXPIRY_DAYS."""
+    cache, sha = load_json_state(github_token, github_repo, SUMMARY_CACHE_FILE)
+    cutoff = (datetime.date.today() - datetime.timedelta(days=SUMMARY_CACHE_EXPIRY_DAYS)).isoformat()
+    fresh = {key: entry for key, entry in cache.items() if entry.get("date", "") >= cutoff}
+    if len(fresh) < len(cache):
+        print(f"  {len(cache) - len(fresh)} resumos expirados removidos")
+    return fresh, sha
  
  
 # ─────────────────────────────────────────────
@@ -118,44 +180,65 @@ def load_config_from_sheet(sheet_csv_urls: dict) -> dict:
     import csv, io
  
     def fetch_tab(url):
-        r = requests.get(url, timeout=15)
+        r = SESSION.get(url, timeout=15)
         r.raise_for_status()
-        reader = csv.DictReader(io.StringIO(r.text))
-        return list(reader)
+        # Plain rows + header positions: no dict per row like DictReader
+        rows = list(csv.reader(io.StringIO(r.text)))
+        if not rows:
+            return {}, []
+        return {name: i for i, name in enumerate(rows[0])}, rows[1:]
+ 
+    def column(header, *names):
+        """Position of the first of names present in the header, or None."""
+        return next((header[n] for n in names if n in header), None)
+ 
+    def cell(row, i, default=""):
+        return row[i] if i is not None and i < len(row) else default
  
-    feeds_rows      = fetch_tab(sheet_csv_urls["feeds"])
-    keywords_rows   = fetch_tab(sheet_csv_urls["keywords"])
-    recipients_rows = fetch_tab(sheet_csv_urls["recipients"])
-    scrape_rows     = fetch_tab(sheet_csv_urls["scrape"])
+    def active_rows(header, rows, required):
+        """Rows with active == yes (checked first) and a non-empty required column."""
+        i_active, i_required = column(header, "active"), column(header, required)
+        return [row for row in rows if cell(row, i_active).lower() == "yes" and cell(row, i_required)]
+ 
+    # The four tabs are independent downloads: fetch them in parallel
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        feeds_tab, keywords_tab, recipients_tab, scrape_tab = ex.map(
+            fetch_tab, [sheet_csv_urls[k] for k in ("feeds", "keywords", "recipients", "scrape")])
  
     # feeds: name, url, active, group
+    header, rows = feeds_tab
+    i_url, i_group = column(header, "url"), column(header, "Group", "group")
     feeds = [
-        {"url": r["url"], "group": r.get("Group") or r.get("group") or "Outras Fontes"}
-        for r in feeds_rows
-        if r.get("active","").lower() == "yes" and r.get("url")
+        {"url": row[i_url], "group": cell(row, i_group) or "Outras Fontes"}
+        for row in active_rows(header, rows, "url")
     ]
  
     # keywords: keyword, active, groups (optional — comma-separated group names that restrict this keyword)
+    header, rows = keywords_tab
+    i_keyword, i_groups = column(header, "keyword"), column(header, "Groups", "groups")
     keywords = []
-    for r in keywords_rows:
-        if r.get("active","").lower() != "yes" or not r.get("keyword"):
-            continue
-        groups_str = (r.get("Groups") or r.get("groups") or "").strip()
-        restricted_groups = [g.strip() for g in groups_str.split(",") if g.strip()] if groups_str else []
-        keywords.append({"keyword": r["keyword"], "restricted_groups": restricted_groups})
+    for row in active_rows(header, rows, "keyword"):
+        groups_str = cell(row, i_groups).strip()
+        # frozenset: matching checks `group in restricted_groups` once per hit
+        restricted_groups = frozenset(g.strip() for g in groups_str.split(",") if g.strip())
+        keywords.append({"keyword": row[i_keyword], "restricted_groups": restricted_groups})
  
     # recipients: email, active, name
+    header, rows = recipients_tab
+    i_email, i_name = column(header, "email"), column(header, "name")
     recipients = [
-        {"email": r["email"], "name": r.get("name", r["email"])}
-        for r in recipients_rows
-        if r.get("active","").lower() == "yes" and r.get("email")
+        {"email": row[i_email], "name": cell(row, i_name, row[i_email])}
+        for row in active_rows(header, rows, "email")
     ]
  
     # scrape: name, url, selector, active, group
+    header, rows = scrape_tab
+    i_name, i_url = column(header, "name"), column(header, "url")
+    i_selector, i_group = column(header, "selector"), column(header, "Group", "group")
     scrape = [
-        {"name": r["name"], "url": r["url"], "selector": r.get("selector","a"), "group": r.get("Group") or r.get("group") or "Outras Fontes"}
-        for r in scrape_rows
-        if r.get("active","").lower() == "yes" and r.get("url")
+        {"name": cell(row, i_name), "url": row[i_url], "selector": cell(row, i_selector, "a"),
+         "group": cell(row, i_group) or "Outras Fontes"}
+        for row in active_rows(header, rows, "url")
     ]
  
     return {"feeds": feeds, "keywords": keywords, "recipients": recipients, "scrape": scrape}
@@ -165,53 +248,227 @@ def load_config_from_sheet(sheet_csv_urls: dict) -> dict:
 # 2. FETCH & FILTER RSS FEEDS
 # ─────────────────────────────────────────────
  
-def fetch_rss_articles(feeds: list, keywords: list, max_age_days: int = 1) -> list:
-    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=max_age_days)
-    articles = []
+def build_keyword_matcher(keywords: list):
+    """Return match(text, group) -> list of keywords found in text that apply to group.
+    All keywords are located in a single Aho-Corasick pass when ahocorasick_rs or
+    pyahocorasick is installed; otherwise a regex alternation prefilters the text."""
+    # casefold (not lower) on both sides so e.g. "ß"/"SS" and other caseless forms compare equal
+    folded   = [(kw, kw["keyword"].casefold()) for kw in keywords]
+    patterns = list(dict.fromkeys(kwl for _, kwl in folded))
+ 
+    # Last-resort backend: one regex scan rejects non-matching text (the majority),
+    # and only texts that hit anything pay for the per-keyword pass
+    any_keyword = re.compile("|".join(re.escape(p) for p in patterns)) if patterns else None
+ 
+    def find(text):
+        if any_keyword is None or not any_keyword.search(text):
+            return set()
+        return {p for p in patterns if p in text}
  
-    for feed_cfg in feeds:
-        url   = feed_cfg["url"]
-        group = feed_cfg["group"]
+    if patterns:
         try:
-            feed = feedparser.parse(url)
-            source_name = feed.feed.get("title", url)
+            import ahocorasick_rs
+            ac = ahocorasick_rs.AhoCorasick(patterns)
+ 
+            def find(text):
+                # overlapping=True so "net" is still found inside "network", like `in` does
+                return {patterns[i] for i, _, _ in ac.find_matches_as_indexes(text, overlapping=True)}
+        except ImportError:
+            try:
+                import ahocorasick   # pyahocorasick (C extension)
+                automaton = ahocorasick.Automaton()
+                for p in patterns:
+                    automaton.add_word(p, p)
+                automaton.make_automaton()
+ 
+                def find(text):
+                    return {p for _, p in automaton.iter(text)}
+            except ImportError:
+                pass
+ 
+    def match(text, group):
+        found = find(text.casefold())
+        if not found:   # the common case: no keyword at all, skip the per-keyword filter
+            return []
+        return [
+            kw["keyword"] for kw, kwl in folded
+            if kwl in found
+            and (not kw["restricted_groups"] or group in kw["restricted_groups"])
+        ]
+ 
+    return match
+ 
+ 
+RSS_FETCH_WORKERS      = 10
+FEED_PARSE_INLINE_MAX  = 50_000   # bytes; larger feeds are parsed in worker processes
+MAX_ENTRIES_PER_FEED   = 50       # hard cap per feed, newest entries first
+FEED_MAX_BYTES         = 5_000_000   # download cap; a truncated feed still yields its newest entries
+ 
+def read_capped(r, limit: int) -> tuple[bytes, bool]:
+    """Body of a stream=True response, at most limit bytes; the flag says if it was cut.
+    Bodies under the limit are read to the end, so the connection goes back to the pool."""
+    chunks = []
+    size = 0
+    for chunk in r.iter_content(chunk_size=64 * 1024):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            return b"".join(chunks)[:limit], True
+    return b"".join(chunks), False
+ 
+ 
+def fetch_feed(url: str, validators: dict) -> tuple[bytes | None, dict, dict]:
+    """Conditional GET using the ETag / Last-Modified seen on the previous run.
+    Returns (body, response_headers, validators); body is None when the server answers 304.
+    response_headers go to feedparser.parse so relative entry links resolve against the
+    final feed URL, as they did when feedparser fetched the URL itself."""
+    headers = dict(HEADERS)
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    with SESSION.get(url, headers=headers, timeout=15, stream=True) as r:
+        if r.status_code == 304:
+            return None, {}, validators
+        r.raise_for_status()
+        response_headers = {"content-location": r.url, "content-type": r.headers.get("Content-Type", "")}
+        new_validators = {}
+        if r.headers.get("ETag"):
+            new_validators["etag"] = r.headers["ETag"]
+        if r.headers.get("Last-Modified"):
+            new_validators["last_modified"] = r.headers["Last-Modified"]
+ 
+        # Stream with a ceiling: multi-MB podcast/archive feeds stop at FEED_MAX_BYTES
+        body, truncated = read_capped(r, FEED_MAX_BYTES)
+        if truncated:
+            print(f"[WARN] Feed {url} excede {FEED_MAX_BYTES // 1_000_000} MB, truncado")
+    return body, response_headers, new_validators
+ 
+ 
+def parse_feed_in_worker(body: bytes, response_headers: dict):
+    """feedparser.parse for the process pool. A malformed ("bozo") feed carries a
+    SAXParseException that cannot be pickled back, so it is replaced by its repr."""
+    feed = feedparser.parse(body, response_headers=response_headers)
+    if "bozo_exception" in feed:
+        feed["bozo_exception"] = repr(feed["bozo_exception"])
+    return feed
+ 
+ 
+def entry_timestamp(entry) -> float:
+    """Epoch seconds of an entry's date (feedparser's *_parsed are UTC); undated is +inf."""
+    published = entry.get("published_parsed") or entry.get("updated_parsed")
+    return calendar.timegm(published) if published else float("inf")
+ 
+ 
+def articles_from_feed(feed, feed_cfg: dict, match_keywords, cutoff_ts: int, seen_links: set) -> list:
+    """Keyword-matching entries of one parsed feed published after cutoff_ts."""
+    group = feed_cfg["group"]
+    source_name = feed.feed.get("title", feed_cfg["url"])
+    articles = []
  
-            for entry in feed.entries:
-                published = None
-                if hasattr(entry, "published_parsed") and entry.published_parsed:
-                    published = datetime.datetime(*entry.published_parsed[:6])
-                elif hasattr(entry, "updated_parsed") and entry.updated_parsed:
-                    published = datetime.datetime(*entry.updated_parsed[:6])
+    # Not every feed lists newest first (some are oldest first): sort before capping,
+    # so the cap keeps the fresh entries and the first old one means the rest is archive.
+    # Undated entries sort in front, as they were never treated as stale.
+    entries = sorted(feed.entries, key=entry_timestamp, reverse=True)
+    for entry in entries[:MAX_ENTRIES_PER_FEED]:
+        if entry_timestamp(entry) < cutoff_ts:
+            break
+        published = entry.get("published_parsed") or entry.get("updated_parsed")
+ 
+        title   = entry.get("title", "")
+        summary = entry.get("summary", "") or entry.get("description", "")
+        link    = entry.get("link", "")
+ 
+        link_key = canonical_url(link)
+        if link_key in seen_links:
+            continue
+ 
+        matched_keywords = match_keywords(title + " " + summary, group)
+ 
+        if matched_keywords:
+            seen_links.add(link_key)
+            articles.append({
+                "source":           source_name,
+                "group":            group,
+                "original_title":   title,
+                "original_summary": summary[:1000],
+                "link":             link,
+                "published":        time.strftime("%Y-%m-%d", published) if published else "unknown",
+                "matched_keywords": matched_keywords,
+                "type":             "rss",
+            })
+ 
+    return articles
  
-                if published and published < cutoff:
-                    continue
  
-                title   = entry.get("title", "")
-                summary = entry.get("summary", "") or entry.get("description", "")
-                link    = entry.get("link", "")
- 
-                text = (title + " " + summary).lower()
-                matched_keywords = [
-                    kw["keyword"] for kw in keywords
-                    if kw["keyword"].lower() in text
-                    and (not kw["restricted_groups"] or group in kw["restricted_groups"])
-                ]
- 
-                if matched_keywords:
-                    articles.append({
-                        "source":           source_name,
-                        "group":            group,
-                        "original_title":   title,
-                        "original_summary": summary[:1000],
-                        "link":             link,
-                        "published":        published.strftime("%Y-%m-%d") if published else "unknown",
-                        "matched_keywords": matched_keywords,
-                        "type":             "rss",
-                    })
+def fetch_rss_articles(feeds: list, match_keywords, max_age_days: int = 1,
+                       feed_cache: dict = None, seen_links: set = None) -> list:
+    """feed_cache ({url: validators}) is updated in place with the validators to send next run.
+    seen_links (canonical URLs) is shared with the scraper: links already in it are skipped."""
+    cutoff    = datetime.datetime.utcnow() - datetime.timedelta(days=max_age_days)
+    cutoff_ts = calendar.timegm(cutoff.utctimetuple())
+    articles = []
+    if feed_cache is None:
+        feed_cache = {}
+    if seen_links is None:
+        seen_links = set()
  
+    def download(feed_cfg):
+        url = feed_cfg["url"]
+        try:
+            return fetch_feed(url, feed_cache.get(url, {}))
         except Exception as e:
             print(f"[WARN] RSS failed for {url}: {e}")
+            return None
+ 
+    # Downloads run concurrently (network-bound); parsing stays sequential
+    with ThreadPoolExecutor(max_workers=RSS_FETCH_WORKERS) as ex:
+        results = list(ex.map(download, feeds))
+ 
+    active_urls = {f["url"] for f in feeds}
+    for url in [u for u in feed_cache if u not in active_urls]:
+        del feed_cache[url]
+ 
+    # feedparser is CPU-bound and holds the GIL: parse big feeds on other cores.
+    # Small ones stay inline, where pickling the result back would cost more than parsing.
+    big = [i for i, result in enumerate(results)
+           if result and result[0] is not None and len(result[0]) > FEED_PARSE_INLINE_MAX]
+    parsed = {}
+    if len(big) > 1:
+        with ProcessPoolExecutor(max_workers=min(len(big), os.cpu_count() or 1)) as ex:
+            futures = {i: ex.submit(parse_feed_in_worker, results[i][0], results[i][1]) for i in big}
+            for i, fut in futures.items():
+                try:
+                    parsed[i] = fut.result()
+                except Exception:
+                    pass   # parsed again inline below, where the error gets reported
  
+    unchanged = 0
+    for i, (feed_cfg, result) in enumerate(zip(feeds, results)):
+        if result is None:
+            continue
+        url = feed_cfg["url"]
+        body, response_headers, validators = result
+        if body is None:
+            # 304: nothing was added since the last run, which already covered these entries
+            unchanged += 1
+            continue
+        try:
+            feed = parsed[i] if i in parsed else feedparser.parse(body, response_headers=response_headers)
+            articles.extend(articles_from_feed(feed, feed_cfg, match_keywords, cutoff_ts, seen_links))
+        except Exception as e:
+            print(f"[WARN] RSS failed for {url}: {e}")
+            # Forget the validators so next run downloads the feed again instead of a 304
+            feed_cache.pop(url, None)
+            continue
+        # Only remembered once the entries were processed: a 304 next run skips them
+        if validators:
+            feed_cache[url] = validators
+        else:
+            feed_cache.pop(url, None)
+ 
+    if unchanged:
+        print(f"  {unchanged} feeds sem alterações desde a última execução (304)")
     return articles
  
  
@@ -224,25 +481,64 @@ HEADERS = {
     "Accept-Language": "en-US,en;q=0.9",
 }
  
-def get_article_links(source_name: str, index_url: str, selector: str) -> list:
+# Shared keep-alive session for sheets, feeds and scraping: one TLS handshake per host
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50,
+                       max_retries=Retry(total=2, backoff_factor=0.3))
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+ 
+SCRAPE_WORKERS       = 8
+SCRAPE_PER_HOST      = 2      # max concurrent requests to the same site
+SCRAPE_HOST_INTERVAL = 0.5    # min seconds between requests to the same site
+ 
+def decode_html(content: bytes, content_type: str) -> str:
+    """Page bytes as text: HTTP charset first, then <meta charset>, then sniffing.
+    lexbor reads bytes as UTF-8 whatever the page declares, so decode before parsing."""
+    match    = re.search(r"charset=[\"']?([\w.:-]+)", content_type or "", re.I)
+    declared = [match.group(1)] if match else []
     try:
+        from bs4.dammit import UnicodeDammit
+    except ImportError:
+        try:
+            return content.decode(declared[0] if declared else "utf-8", errors="replace")
+        except LookupError:
+            return content.decode("utf-8", errors="replace")
+    # undeclared pages: UTF-8, else windows-1252 (latin-1 superset) rather than chardet guesses
+    dammit = UnicodeDammit(content, known_definite_encodings=declared,
+                           user_encodings=["utf-8", "windows-1252"], is_html=True)
+    if dammit.unicode_markup is None:
+        return content.decode("utf-8", errors="replace")
+    return dammit.unicode_markup
+ 
+ 
+def link_nodes(html: str, selectors: list) -> list:
+    """(text, href) of every element matching one of the CSS selectors, in selector order."""
+    try:
+        from selectolax.lexbor import LexborHTMLParser
+    except ImportError:
         from bs4 import BeautifulSoup
-        r = requests.get(index_url, headers=HEADERS, timeout=20)
+        soup = BeautifulSoup(html, "lxml")
+        return [(tag.get_text(strip=True), tag.get("href", "")) for sel in selectors for tag in soup.select(sel)]
+ 
+    tree = LexborHTMLParser(html)
+    return [(node.text(strip=True), node.attributes.get("href") or "") for sel in selectors for node in tree.css(sel)]
+ 
+ 
+def get_article_links(source_name: str, index_url: str, selectors: list) -> list:
+    try:
+        r = SESSION.get(index_url, headers=HEADERS, timeout=20)
         r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
  
         base_domain = f"{urlparse(index_url).scheme}://{urlparse(index_url).netloc}"
         links = []
  
-        for sel in selector.split(","):
-            sel = sel.strip()
-            for tag in soup.select(sel):
-                href = tag.get("href", "")
-                if not href or href.startswith("#") or href.startswith("javascript"):
-                    continue
-                full_url = urljoin(base_domain, href)
-                if urlparse(full_url).netloc == urlparse(index_url).netloc:
-                    links.append((tag.get_text(strip=True), full_url))
+        for text, href in link_nodes(decode_html(r.content, r.headers.get("Content-Type", "")), selectors):
+            if not href or href.startswith("#") or href.startswith("javascript"):
+                continue
+            full_url = urljoin(base_domain, href)
+            if urlparse(full_url).netloc == urlparse(index_url).netloc:
+                links.append((text, full_url))
  
         seen = set()
         unique = []
@@ -259,79 +555,151 @@ def get_article_links(source_name: str, index_url: str, selector: str) -> list:
         return []
  
  
+ARTICLE_NOISE_TAGS = ["nav", "header", "footer", "script", "style", "aside", "form"]
+ARTICLE_CONTAINERS = ["article", "main", ".content", ".article-body", ".entry-content", ".post-content", "#content"]
+ARTICLE_MAX_BYTES  = 1_048_576   # article text sits near the top; the rest of a huge page is not read
+ 
 def scrape_article(url: str) -> str:
     try:
-        from bs4 import BeautifulSoup
-        r = requests.get(url, headers=HEADERS, timeout=20)
-        r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
+        # Streamed and capped: a multi-MB page never sits whole in memory, in any worker
+        with SESSION.get(url, headers=HEADERS, timeout=20, stream=True) as r:
+            r.raise_for_status()
+            content, _ = read_capped(r, ARTICLE_MAX_BYTES)
+            html = decode_html(content, r.headers.get("Content-Type", ""))
+        try:
+            from selectolax.lexbor import LexborHTMLParser
+        except ImportError:
+            return scrape_article_bs4(html)
  
-        for tag in soup(["nav", "header", "footer", "script", "style", "aside", "form"]):
-            tag.decompose()
+        # lexbor (C) parser: much faster than building a BeautifulSoup tree
+        tree = LexborHTMLParser(html)
+        tree.strip_tags(ARTICLE_NOISE_TAGS)
  
-        for selector in ["article", "main", ".content", ".article-body", ".entry-content", ".post-content", "#content"]:
-            container = soup.select_one(selector)
+        for selector in ARTICLE_CONTAINERS:
+            container = tree.css_first(selector)
             if container:
-                text = container.get_text(separator=" ", strip=True)
+                text = container.text(separator=" ", strip=True)
                 if len(text) > 200:
                     return text[:2000]
  
-        paragraphs = soup.find_all("p")
-        text = " ".join(p.get_text(strip=True) for p in paragraphs)
+        text = " ".join(p.text(strip=True) for p in tree.css("p"))
         return text[:2000]
  
     except Exception as e:
         return ""
  
  
-def fetch_scraped_articles(scrape_config: list, keywords: list) -> list:
+def scrape_article_bs4(html: str) -> str:
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "lxml")
+ 
+    for tag in soup(ARTICLE_NOISE_TAGS):
+        tag.decompose()
+ 
+    for selector in ARTICLE_CONTAINERS:
+        container = soup.select_one(selector)
+        if container:
+            text = container.get_text(separator=" ", strip=True)
+            if len(text) > 200:
+                return text[:2000]
+ 
+    paragraphs = soup.find_all("p")
+    text = " ".join(p.get_text(strip=True) for p in paragraphs)
+    return text[:2000]
+ 
+ 
+def fetch_scraped_articles(scrape_config: list, match_keywords, seen_links: set = None,
+                           seen_urls=None) -> list:
+    """seen_links (canonical URLs) is shared with the RSS fetcher, and seen_urls holds links
+    sent on previous runs: neither kind of page is scraped."""
+    if seen_links is None:
+        seen_links = set()
+    if seen_urls is None:
+        seen_urls = set()
     try:
-        from bs4 import BeautifulSoup
+        import selectolax
     except ImportError:
-        print("[WARN] beautifulsoup4 não instalado, a ignorar scraping")
-        return []
+        try:
+            import bs4
+        except ImportError:
+            print("[WARN] selectolax e beautifulsoup4 não instalados, a ignorar scraping")
+            return []
  
-    articles = []
-    seen_urls = set()
+    selectors = [[sel.strip() for sel in cfg["selector"].split(",") if sel.strip()] for cfg in scrape_config]
  
-    for cfg in scrape_config:
-        source_name = cfg["name"]
-        index_url   = cfg["url"]
-        selector    = cfg["selector"]
-        group       = cfg["group"]
+    # Index pages: one request per source, all sources in parallel
+    def links_for(cfg, cfg_selectors):
+        print(f"  A fazer scraping de {cfg['name']}...")
+        return get_article_links(cfg["name"], cfg["url"], cfg_selectors)
  
-        print(f"  A fazer scraping de {source_name}...")
-        links = get_article_links(source_name, index_url, selector)
+    with ThreadPoolExecutor(max_workers=SCRAPE_WORKERS) as ex:
+        links_per_source = list(ex.map(links_for, scrape_config, selectors))
  
+    jobs = []
+    queued = set()
+    already_sent = 0
+    for cfg, links in zip(scrape_config, links_per_source):
         for link_title, article_url in links:
             if article_url in seen_urls:
+                already_sent += 1
                 continue
-            seen_urls.add(article_url)
- 
-            text = scrape_article(article_url)
-            if not text:
+            link_key = canonical_url(article_url)
+            if link_key in queued or link_key in seen_links:
                 continue
+            queued.add(link_key)
+            jobs.append((cfg, link_title, article_url))
+    print(f"  {already_sent} artigos scraping já vistos ignorados, {len(jobs)} a descarregar")
+ 
+    # Article pages: shared pool, politeness enforced per host instead of a global sleep
+    hosts      = {urlparse(url).netloc for _, _, url in jobs}
+    host_slots = {host: threading.Semaphore(SCRAPE_PER_HOST) for host in hosts}
+    host_next  = {host: 0.0 for host in hosts}
+    host_lock  = threading.Lock()
+ 
+    def polite_scrape(url):
+        host = urlparse(url).netloc
+        with host_slots[host]:
+            with host_lock:
+                now  = time.monotonic()
+                wait = max(0.0, host_next[host] - now)
+                host_next[host] = now + wait + SCRAPE_HOST_INTERVAL
+            time.sleep(wait)
+            return scrape_article(url)
+ 
+    # Interleave hosts so workers are not all parked on the same site's semaphore
+    per_host = defaultdict(int)
+    order = []
+    for i, (_, _, url) in enumerate(jobs):
+        host = urlparse(url).netloc
+        order.append((per_host[host], i))
+        per_host[host] += 1
+    order.sort()
+ 
+    texts = [""] * len(jobs)
+    with ThreadPoolExecutor(max_workers=SCRAPE_WORKERS) as ex:
+        futures = {i: ex.submit(polite_scrape, jobs[i][2]) for _, i in order}
+        for i, fut in futures.items():
+            texts[i] = fut.result()
  
-            full_text = (link_title + " " + text).lower()
-            matched_keywords = [
-                kw["keyword"] for kw in keywords
-                if kw["keyword"].lower() in full_text
-                and (not kw["restricted_groups"] or cfg["group"] in kw["restricted_groups"])
-            ]
- 
-            if matched_keywords:
-                articles.append({
-                    "source":           source_name,
-                    "group":            group,
-                    "original_title":   link_title or article_url,
-                    "original_summary": text[:1000],
-                    "link":             article_url,
-                    "published":        "unknown",
-                    "matched_keywords": matched_keywords,
-                    "type":             "scraped",
-                })
- 
-            time.sleep(0.5)
+    articles = []
+    for (cfg, link_title, article_url), text in zip(jobs, texts):
+        if not text:
+            continue
+ 
+        matched_keywords = match_keywords(link_title + " " + text, cfg["group"])
+ 
+        if matched_keywords:
+            seen_links.add(canonical_url(article_url))
+            articles.append({
+                "source":           cfg["name"],
+                "group":            cfg["group"],
+                "original_title":   link_title or article_url,
+                "original_summary": text[:1000],
+                "link":             article_url,
+                "published":        "unknown",
+                "matched_keywords": matched_keywords,
+                "type":             "scraped",
+            })
  
     print(f"  Scraping concluído — {len(articles)} artigos encontrados")
     return articles
@@ -341,18 +709,51 @@ def fetch_scraped_articles(scrape_config: list, keywords: list) -> list:
 # 4. DEDUPLICATE
 # ─────────────────────────────────────────────
  
+TRACKING_PARAMS = ("utm_", "fbclid", "gclid")
+ 
+def canonical_url(url: str) -> str:
+    """Dedup key for a link: lowercase host, no fragment, no tracking query params."""
+    p = urlparse(url.strip())
+    query = "&".join(q for q in p.query.split("&") if q and not q.startswith(TRACKING_PARAMS))
+    return urlunparse(p._replace(netloc=p.netloc.lower(), query=query, fragment=""))
+ 
+ 
+TITLE_MATCH_MIN_WORDS = 4   # shorter titles are too generic to match on words alone
+# Words whose presence alone never makes two headlines different stories (pt + en)
+TITLE_STOPWORDS = frozenset("""
+    a o as os um uma de do da dos das e em no na nos nas ao aos à às para por com
+    the an of in on at to for and or with by from is are
+""".split())
+ 
+def title_tokens(title: str) -> list:
+    """Casefolded content words of a title: punctuation and stopwords dropped."""
+    return [t for t in re.findall(r"\w+", title.casefold()) if t not in TITLE_STOPWORDS]
+ 
+ 
 def deduplicate(articles: list) -> list:
-    seen_urls   = set()
-    seen_titles = set()
+    """Drop repeated links, repeated titles and titles with the same content words
+    (the same story syndicated with different case, punctuation or articles) before
+    anything is sent to Claude. The fetchers already skip links seen earlier in the
+    run; this is the cross-source pass."""
+    seen_urls    = set()
+    seen_titles  = set()
+    seen_words   = set()   # content-word sets of the titles kept
     unique = []
  
     for art in articles:
-        url       = art["link"]
+        url       = canonical_url(art["link"])
         title_key = art["original_title"].lower().strip()[:60]
  
         if url in seen_urls or title_key in seen_titles:
             continue
  
+        tokens = title_tokens(art["original_title"])
+        if len(tokens) >= TITLE_MATCH_MIN_WORDS:
+            token_set = frozenset(tokens)
+            if token_set in seen_words:
+                continue
+            seen_words.add(token_set)
+ 
         seen_urls.add(url)
         seen_titles.add(title_key)
         unique.append(art)
@@ -364,99 +765,226 @@ def deduplicate(articles: list) -> list:
 # 5. SUMMARISE WITH CLAUDE API (in Portuguese)
 # ─────────────────────────────────────────────
  
-def summarise_articles(articles: list, api_key: str) -> list:
-    if not articles:
-        return []
+CLAUDE_MODEL          = "claude-haiku-4-5-20251001"
+CLAUDE_WORKERS        = 8         # concurrent direct requests to the API
+BATCH_API_MAX_WAIT    = 20 * 60   # seconds to wait for the Message Batches API before falling back
+BATCH_API_CANCEL_WAIT = 5 * 60    # seconds for a cancelled batch to settle before its results are read
  
-    client = anthropic.Anthropic(api_key=api_key)
-    summarised = []
+# Static part of the batch prompt, sent as a cacheable system block; only the articles vary
+SUMMARY_INSTRUCTIONS = """És o editor de uma newsletter profissional de telecomunicações lida por especialistas em assuntos regulatórios da NOS (operadora portuguesa de telecomunicações).
  
-    batch_size = 10
-    for i in range(0, len(articles), batch_size):
-        batch = articles[i:i+batch_size]
+Para cada artigo que te for enviado, produz:
+1. Um TÍTULO claro e profissional em português (máximo 12 palavras)
+2. Um RESUMO em português de exatamente ~100 palavras que capture os factos principais, as implicações regulatórias e a relevância para a indústria europeia de telecomunicações.
+ 
+Devolve os resultados com a ferramenta emit_summaries: um item por artigo, pela mesma ordem dos artigos."""
+ 
+# Structured output: the model fills this tool's input instead of writing JSON as text
+SUMMARY_TOOL = {
+    "name": "emit_summaries",
+    "description": "Regista o título e o resumo de cada artigo, pela ordem recebida.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "title":   {"type": "string"},
+                        "summary": {"type": "string"},
+                    },
+                    "required": ["title", "summary"],
+                },
+            },
+        },
+        "required": ["items"],
+    },
+}
+SUMMARY_TOOL_CHOICE = {"type": "tool", "name": "emit_summaries"}
  
-        articles_text = ""
-        for j, art in enumerate(batch):
-            articles_text += f"""
+def format_articles(batch: list) -> str:
+    articles_text = ""
+    for j, art in enumerate(batch):
+        articles_text += f"""
 ARTIGO {j+1}:
 Fonte: {art['source']}
 Título original: {art['original_title']}
 Conteúdo: {art['original_summary']}
 ---"""
+    return articles_text.strip()
  
-        prompt = f"""És o editor de uma newsletter profissional de telecomunicações lida por especialistas em assuntos regulatórios da NOS (operadora portuguesa de telecomunicações).
  
-Para cada artigo abaixo, produz:
-1. Um TÍTULO claro e profissional em português (máximo 12 palavras)
-2. Um RESUMO em português de exatamente ~100 palavras que capture os factos principais, as implicações regulatórias e a relevância para a indústria europeia de telecomunicações.
+def tool_summaries(message) -> list:
+    """The [{"title", "summary"}, ...] list from the emit_summaries call in a response."""
+    for block in message.content:
+        if block.type == "tool_use" and block.name == SUMMARY_TOOL["name"]:
+            return block.input.get("items", [])
+    raise ValueError("resposta sem chamada a emit_summaries")
  
-Devolve a resposta como um array JSON, um objeto por artigo, com as chaves: "title" e "summary".
-Devolve APENAS o array JSON, sem qualquer outro texto.
  
-{articles_text}"""
+def summarise_with_batch_api(client, articles: list) -> list:
+    """Summarise through the Message Batches API (half price, one request per article).
+    Fills in articles in place and returns those still without a summary, either because
+    their request failed or because the batch was cancelled at BATCH_API_MAX_WAIT before
+    reaching them; results that succeeded before the cancel are still used."""
+    done  = set()
+    batch = None
+    try:
+        batch = client.messages.batches.create(requests=[
+            {
+                "custom_id": f"a{idx}",
+                "params": {
+                    "model": CLAUDE_MODEL,
+                    "max_tokens": 1000,
+                    "system": [{"type": "text", "text": SUMMARY_INSTRUCTIONS, "cache_control": {"type": "ephemeral"}}],
+                    "tools": [SUMMARY_TOOL],
+                    "tool_choice": SUMMARY_TOOL_CHOICE,
+                    "messages": [{"role": "user", "content": format_articles([art])}],
+                },
+            }
+            for idx, art in enumerate(articles)
+        ])
+        print(f"  Lote {batch.id} submetido à Batches API ({len(articles)} artigos)")
+ 
+        deadline = time.monotonic() + BATCH_API_MAX_WAIT
+        delay = 5
+        cancelled = False
+        while batch.processing_status != "ended":
+            if not cancelled and time.monotonic() > deadline:
+                # Cancel, but keep polling: requests that already succeeded are billed
+                # and still come back in the results once the batch has ended
+                print(f"[WARN] Lote {batch.id} não terminou em {BATCH_API_MAX_WAIT // 60} min, a cancelar")
+                client.messages.batches.cancel(batch.id)
+                cancelled = True
+                deadline = time.monotonic() + BATCH_API_CANCEL_WAIT
+                delay = 5
+            elif cancelled and time.monotonic() > deadline:
+                print(f"[WARN] Lote {batch.id} não terminou o cancelamento, resultados ignorados")
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+            batch = client.messages.batches.retrieve(batch.id)
+        else:
+            for result in client.messages.batches.results(batch.id):
+                if result.result.type != "succeeded":
+                    continue
+                idx = int(result.custom_id[1:])
+                try:
+                    s = tool_summaries(result.result.message)[0]
+                except Exception:
+                    continue
+                summary = s.get("summary", "")
+                if summary and len(summary) >= 20:
+                    articles[idx]["title"]   = s.get("title", articles[idx]["original_title"])
+                    articles[idx]["summary"] = summary
+                    done.add(idx)
+ 
+    except Exception as e:
+        print(f"[WARN] Batches API falhou: {e}")
+        # The direct path redoes these articles: stop the batch so they aren't billed twice
+        if batch is not None and batch.processing_status != "ended":
+            try:
+                client.messages.batches.cancel(batch.id)
+            except Exception as e:
+                print(f"[WARN] Não foi possível cancelar o lote {batch.id}: {e}")
+ 
+    return [art for idx, art in enumerate(articles) if idx not in done]
  
-        try:
-            response = client.messages.create(
-                model="claude-haiku-4-5-20251001",
-                max_tokens=4000,
-                messages=[{"role": "user", "content": prompt}]
-            )
- 
-            raw = response.content[0].text.strip()
-            # Strip markdown fences
-            if "```" in raw:
-                parts = raw.split("```")
-                for part in parts:
-                    part = part.strip()
-                    if part.startswith("json"):
-                        part = part[4:].strip()
-                    if part.startswith("["):
-                        raw = part
-                        break
-            raw = raw.strip()
- 
-            summaries = json.loads(raw)
- 
-            for j, art in enumerate(batch):
-                s = summaries[j] if j < len(summaries) else {}
-                art["title"]   = s.get("title", art["original_title"])
-                art["summary"] = s.get("summary", "")
-                # Validate we got a real summary, not empty
-                if not art["summary"] or len(art["summary"]) < 20:
-                    print(f"[WARN] Resumo vazio para artigo {j+1}, a tentar novamente...")
-                    retry = client.messages.create(
-                        model="claude-haiku-4-5-20251001",
-                        max_tokens=500,
-                        messages=[{"role": "user", "content": f'''Resume em português em ~100 palavras este artigo para uma newsletter de regulação de telecomunicações. Devolve apenas o resumo, sem mais texto.
+ 
+def summarise_plain(client, art: dict) -> str:
+    """Plain-text summary, for when the structured call gave nothing usable."""
+    retry = client.messages.create(
+        model=CLAUDE_MODEL,
+        max_tokens=500,
+        messages=[{"role": "user", "content": f'''Resume em português em ~100 palavras este artigo para uma newsletter de regulação de telecomunicações. Devolve apenas o resumo, sem mais texto.
  
 Título: {art["original_title"]}
 Conteúdo: {art["original_summary"]}'''}]
-                    )
-                    art["summary"] = retry.content[0].text.strip()
-                summarised.append(art)
+    )
+    return retry.content[0].text.strip()
+ 
  
+def summarise_one(client, art: dict) -> dict:
+    """Fill in "title" and "summary" for one article (in place) and return it.
+    A failure only ever affects this article."""
+    try:
+        response = client.messages.create(
+            model=CLAUDE_MODEL,
+            max_tokens=1000,
+            system=[{"type": "text", "text": SUMMARY_INSTRUCTIONS, "cache_control": {"type": "ephemeral"}}],
+            tools=[SUMMARY_TOOL],
+            tool_choice=SUMMARY_TOOL_CHOICE,
+            messages=[{"role": "user", "content": format_articles([art])}]
+        )
+        summaries = tool_summaries(response)
+        s = summaries[0] if summaries else {}
+        art["title"]   = s.get("title", art["original_title"])
+        art["summary"] = s.get("summary", "")
+    except Exception as e:
+        print(f"[WARN] Resumo falhou para {art['link']}: {e}")
+        art["title"]   = art["original_title"]
+        art["summary"] = ""
+ 
+    # Validate we got a real summary, not empty
+    if not art["summary"] or len(art["summary"]) < 20:
+        try:
+            art["summary"] = summarise_plain(client, art)
         except Exception as e:
-            print(f"[WARN] Resumo falhou para o lote {i//batch_size + 1}: {e}")
-            # Retry each article individually
-            for art in batch:
-                try:
-                    retry = client.messages.create(
-                        model="claude-haiku-4-5-20251001",
-                        max_tokens=500,
-                        messages=[{"role": "user", "content": f'''Resume em português em ~100 palavras este artigo para uma newsletter de regulação de telecomunicações. Devolve apenas o resumo, sem mais texto.
+            print(f"[WARN] Retry também falhou: {e}")
+            art["title"]   = art["original_title"]
+            art["summary"] = "[Resumo não disponível]"
  
-Título: {art["original_title"]}
-Conteúdo: {art["original_summary"]}'''}]
-                    )
-                    art["title"]   = art["original_title"]
-                    art["summary"] = retry.content[0].text.strip()
-                except Exception as e2:
-                    print(f"[WARN] Retry também falhou: {e2}")
-                    art["title"]   = art["original_title"]
-                    art["summary"] = "[Resumo não disponível]"
-                summarised.append(art)
+    return art
+ 
+ 
+def summary_cache_key(art: dict) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for part in (art["link"], art["original_title"], art["original_summary"][:500]):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
  
-    return summarised
+ 
+def summarise_articles(articles: list, api_key: str, cache: dict = None) -> list:
+    """cache ({article_hash: {...}}) is consulted first and updated in place with new summaries."""
+    if not articles:
+        return []
+    if cache is None:
+        cache = {}
+ 
+    # Articles summarised on a previous run skip the API entirely
+    pending = []
+    for art in articles:
+        hit = cache.get(summary_cache_key(art))
+        if hit:
+            art["title"]   = hit["title"]
+            art["summary"] = hit["summary"]
+        else:
+            pending.append(art)
+    if len(pending) < len(articles):
+        print(f"  {len(articles) - len(pending)} resumos reutilizados da cache, {len(pending)} a gerar")
+    if not pending:
+        return articles
+ 
+    client = anthropic.Anthropic(api_key=api_key)
+ 
+    # Nobody waits on this job interactively: prefer the half-price Batches API and only
+    # send what it could not handle (failures, or a batch that ran too long) directly
+    leftover = summarise_with_batch_api(client, pending)
+    if leftover:
+        print(f"  {len(leftover)} artigos a resumir com chamadas directas")
+        # One request per article, run concurrently: small outputs, and a bad
+        # response costs one article instead of a whole multi-article batch
+        with ThreadPoolExecutor(max_workers=CLAUDE_WORKERS) as ex:
+            list(ex.map(summarise_one, [client] * len(leftover), leftover))
+ 
+    today_str = datetime.date.today().isoformat()
+    for art in pending:
+        if art["summary"] and art["summary"] != "[Resumo não disponível]":
+            cache[summary_cache_key(art)] = {"title": art["title"], "summary": art["summary"], "date": today_str}
+ 
+    return articles
  
  
 # ─────────────────────────────────────────────
@@ -473,14 +1001,33 @@ GROUP_ORDER = [
     "Outras Fontes",
 ]
  
-def build_html_email(articles: list, date_str: str, recipient_name: str) -> str:
+# Per-article markup, parsed once at import instead of as an f-string on every
+# iteration; filled with format_map from already-escaped fields.
+ITEM_TEMPLATE = """
+            <div style="border-left:3px solid #1a73e8;padding:12px 16px;margin-bottom:20px;background:#fafafa;border-radius:0 6px 6px 0;">
+                <p style="margin:0 0 4px 0;font-size:11px;color:#888;text-transform:uppercase;letter-spacing:0.5px;">
+                    {source}{source_badge}{pub_str}
+                </p>
+                <h3 style="margin:4px 0 8px 0;font-size:16px;color:#1a1a1a;">
+                    <a href="{link}" style="color:#1a1a1a;text-decoration:none;">{title}</a>
+                </h3>
+                <p style="margin:0 0 10px 0;font-size:14px;color:#444;line-height:1.6;">{summary}</p>
+                <div style="margin-bottom:6px;">{kw_tags}</div>
+                <a href="{link}" style="font-size:12px;color:#1a73e8;">Ler artigo completo →</a>
+            </div>"""
+KEYWORD_TAG_TEMPLATE = "<span style='background:#e8f4fd;color:#1a73e8;padding:2px 8px;border-radius:12px;font-size:11px;margin-right:4px;'>{}</span>"
+WEB_BADGE            = "<span style='background:#fff3e0;color:#e65100;padding:2px 6px;border-radius:4px;font-size:10px;margin-left:6px;'>WEB</span>"
+ 
+def render_sections(articles: list) -> tuple[str, int]:
+    """Grouped article markup and article count. Identical for every recipient,
+    so it is rendered once per run and reused by build_html_email."""
     # Group articles
     grouped = defaultdict(list)
     for art in articles:
         grouped[art.get("group", "Outras Fontes")].append(art)
  
-    # Build sections in defined order
-    sections = ""
+    # Build sections in defined order (collect parts, join once: no quadratic +=)
+    section_parts = []
     total = 0
     for group_name in GROUP_ORDER:
         group_articles = grouped.get(group_name, [])
@@ -488,45 +1035,47 @@ def build_html_email(articles: list, date_str: str, recipient_name: str) -> str:
             continue
  
         total += len(group_articles)
-        items = ""
+        item_parts = []
         for art in group_articles:
-            kw_tags = " ".join(
-                f"<span style='background:#e8f4fd;color:#1a73e8;padding:2px 8px;border-radius:12px;font-size:11px;margin-right:4px;'>{kw}</span>"
-                for kw in art.get("matched_keywords", [])
-            )
-            source_badge = ""
-            if art.get("type") == "scraped":
-                source_badge = "<span style='background:#fff3e0;color:#e65100;padding:2px 6px;border-radius:4px;font-size:10px;margin-left:6px;'>WEB</span>"
+            kw_tags = " ".join(KEYWORD_TAG_TEMPLATE.format(escape(kw)) for kw in art.get("matched_keywords", []))
+            source_badge = WEB_BADGE if art.get("type") == "scraped" else ""
  
             pub = art.get("published","")
-            pub_str = f" &nbsp;·&nbsp; {pub}" if pub and pub != "unknown" else ""
- 
-            items += f"""
-            <div style="border-left:3px solid #1a73e8;padding:12px 16px;margin-bottom:20px;background:#fafafa;border-radius:0 6px 6px 0;">
-                <p style="margin:0 0 4px 0;font-size:11px;color:#888;text-transform:uppercase;letter-spacing:0.5px;">
-                    {art['source']}{source_badge}{pub_str}
-                </p>
-                <h3 style="margin:4px 0 8px 0;font-size:16px;color:#1a1a1a;">
-                    <a href="{art['link']}" style="color:#1a1a1a;text-decoration:none;">{art['title']}</a>
-                </h3>
-                <p style="margin:0 0 10px 0;font-size:14px;color:#444;line-height:1.6;">{art['summary']}</p>
-                <div style="margin-bottom:6px;">{kw_tags}</div>
-                <a href="{art['link']}" style="font-size:12px;color:#1a73e8;">Ler artigo completo →</a>
-            </div>"""
- 
-        sections += f"""
+            pub_str = f" &nbsp;·&nbsp; {escape(pub)}" if pub and pub != "unknown" else ""
+            # Feed/scraped/model text is untrusted: escape it so it can't break the markup
+            item_parts.append(ITEM_TEMPLATE.format_map({
+                "source":       escape(art["source"]),
+                "source_badge": source_badge,
+                "pub_str":      pub_str,
+                "link":         escape(art["link"]),
+                "title":        escape(art["title"]),
+                "summary":      escape(art["summary"]),
+                "kw_tags":      kw_tags,
+            }))
+        items = "".join(item_parts)
+ 
+        section_parts.append(f"""
         <div style="margin-bottom:32px;">
             <h2 style="font-size:13px;font-weight:700;text-transform:uppercase;letter-spacing:1px;color:#1a73e8;border-bottom:2px solid #e8f0fe;padding-bottom:8px;margin-bottom:16px;">
                 {group_name} <span style="font-weight:400;color:#999;">({len(group_articles)})</span>
             </h2>
             {items}
-        </div>"""
+        </div>""")
  
+    sections = "".join(section_parts)
     if not sections:
         sections = "<p style='color:#666;'>Não foram encontrados artigos relevantes hoje para as palavras-chave definidas.</p>"
+    return sections, total
+ 
  
-    # First name only for greeting
-    first_name = recipient_name.split()[0] if recipient_name else "colega"
+def greeting_name(recipient_name: str) -> str:
+    """First name only for greeting."""
+    return recipient_name.split()[0] if recipient_name and recipient_name.strip() else "colega"
+ 
+ 
+def build_html_email(sections: str, total: int, date_str: str, recipient_name: str) -> str:
+    """Full email around the pre-rendered sections; only the greeting is per recipient."""
+    first_name = greeting_name(recipient_name)
  
     html = f"""<!DOCTYPE html>
 <html>
@@ -540,7 +1089,7 @@ def build_html_email(articles: list, date_str: str, recipient_name: str) -> str:
   </div>
  
   <!-- Personalised greeting -->
-  <p style="font-size:15px;color:#333;margin-bottom:24px;">Olá, {first_name}!</p>
+  <p style="font-size:15px;color:#333;margin-bottom:24px;">Olá, {escape(first_name)}!</p>
  
   <!-- Grouped articles -->
   {sections}
@@ -558,9 +1107,42 @@ def build_html_email(articles: list, date_str: str, recipient_name: str) -> str:
  
  
 # ─────────────────────────────────────────────
-# 7. SEND VIA GMAIL SMTP (one email per recipient)
+# 7. SEND VIA GMAIL SMTP (one email per greeting)
 # ─────────────────────────────────────────────
  
+def send_emails(recipients: list, articles: list, subject: str, date_str: str,
+                gmail_address: str, gmail_app_password: str):
+    gmail_address      = gmail_address.strip()
+    gmail_app_password = gmail_app_password.strip().replace(" ", "")
+ 
+    # The article markup is the same for everyone: render it once
+    sections, total = render_sections(articles)
+ 
+    # The greeting is the only personal part: recipients sharing a first name get
+    # one message, addressed to all of them through the envelope (BCC)
+    buckets = defaultdict(list)
+    for recipient in recipients:
+        buckets[greeting_name(recipient["name"])].append(recipient)
+ 
+    # One authenticated connection for every recipient
+    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
+        server.login(gmail_address, gmail_app_password)
+ 
+        for first_name, bucket in buckets.items():
+            html_body = build_html_email(sections, total, date_str, first_name)
+            emails    = [recipient["email"] for recipient in bucket]
+ 
+            msg = MIMEMultipart("alternative")
+            msg["Subject"] = subject
+            msg["From"]    = f"Inteligência Regulatória Telecom <{gmail_address}>"
+            # A lone recipient is addressed directly; a shared message doesn't expose the list
+            msg["To"]      = emails[0] if len(emails) == 1 else gmail_address
+            msg.attach(MIMEText(html_body, "html"))
+ 
+            server.send_message(msg, from_addr=gmail_address, to_addrs=emails)
+            for recipient in bucket:
+                print(f"  [OK] Enviado para {recipient['email']} ({recipient['name']})")
+ 
  
 # ─────────────────────────────────────────────
 # 8. MAIN
@@ -587,35 +1169,41 @@ def main():
  
     print(f"[{date_str}] A iniciar geração da newsletter...")
  
-    # 1. Load config
-    print("A carregar configuração do Google Sheets...")
-    config = load_config_from_sheet({
-        "feeds":      SHEET_URL_FEEDS,
-        "keywords":   SHEET_URL_KEYWORDS,
-        "recipients": SHEET_URL_RECIPIENTS,
-        "scrape":     SHEET_URL_SCRAPE,
-    })
+    # 1. Load config and persisted state. They are independent downloads
+    # (Google Sheets + GitHub contents API), so run them concurrently.
+    print("A carregar configuração do Google Sheets e URLs já vistos...")
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        config_job = ex.submit(load_config_from_sheet, {
+            "feeds":      SHEET_URL_FEEDS,
+            "keywords":   SHEET_URL_KEYWORDS,
+            "recipients": SHEET_URL_RECIPIENTS,
+            "scrape":     SHEET_URL_SCRAPE,
+        })
+        seen_job          = ex.submit(load_seen_urls, GITHUB_TOKEN, GITHUB_REPO)
+        feed_cache_job    = ex.submit(load_json_state, GITHUB_TOKEN, GITHUB_REPO, FEED_CACHE_FILE)
+        summary_cache_job = ex.submit(load_summary_cache, GITHUB_TOKEN, GITHUB_REPO)
+ 
+        config = config_job.result()
+        seen_urls, seen_sha = seen_job.result()
+        feed_cache, feed_cache_sha = feed_cache_job.result()
+        summary_cache, summary_cache_sha = summary_cache_job.result()
     print(f"  {len(config['feeds'])} feeds RSS | {len(config['scrape'])} sites scraping | {len(config['keywords'])} palavras-chave | {len(config['recipients'])} destinatários")
  
-    # Load seen URLs
-    print("A carregar URLs já vistos...")
-    seen_urls, seen_sha = load_seen_urls(GITHUB_TOKEN, GITHUB_REPO)
- 
     lookback = 3 if today.weekday() == 0 else 1
+    match_keywords = build_keyword_matcher(config["keywords"])
  
     # 2. Fetch RSS
     print("A obter feeds RSS...")
-    rss_articles = fetch_rss_articles(config["feeds"], config["keywords"], max_age_days=lookback)
+    seen_links = set()   # canonical URLs collected this run, shared by both fetchers
+    rss_articles = fetch_rss_articles(config["feeds"], match_keywords, max_age_days=lookback,
+                                      feed_cache=feed_cache, seen_links=seen_links)
     print(f"  {len(rss_articles)} artigos RSS encontrados")
  
     # 3. Scrape websites
     print("A fazer scraping dos sites...")
-    scraped_articles = fetch_scraped_articles(config["scrape"], config["keywords"])
- 
-    # 3b. Filter scraped articles against seen_urls
-    new_scraped = [a for a in scraped_articles if a["link"] not in seen_urls]
-    print(f"  {len(scraped_articles) - len(new_scraped)} artigos scraping já vistos ignorados, {len(new_scraped)} novos")
-    scraped_articles = new_scraped
+    # Links already sent on previous runs are dropped before their pages are fetched
+    scraped_articles = fetch_scraped_articles(config["scrape"], match_keywords,
+                                              seen_links=seen_links, seen_urls=seen_urls)
  
     # 4. Merge and deduplicate
     all_articles = deduplicate(rss_articles + scraped_articles)
@@ -624,36 +1212,22 @@ def main():
     # 5. Summarise
     if all_articles:
         print("A gerar resumos com Claude...")
-        all_articles = summarise_articles(all_articles, CLAUDE_API_KEY)
+        all_articles = summarise_articles(all_articles, CLAUDE_API_KEY, cache=summary_cache)
  
     subject = f"📡 Inteligência Regulatória Telecom – {today.day} de {months_pt[today.month-1]} de {today.year}"
  
-    # 6. Send one personalised email per recipient
+    # 6. Send the personalised emails (one per distinct first name)
     print(f"A enviar emails para {len(config['recipients'])} destinatários...")
     for r in config["recipients"]:
         print(f"  Destinatário: {r['email']} ({r['name']})")
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-        gmail_address      = GMAIL_ADDRESS.strip()
-        gmail_app_password = GMAIL_APP_PASSWORD.strip().replace(" ", "")
-        server.login(gmail_address, gmail_app_password)
- 
-        for recipient in config["recipients"]:
-            first_name = recipient["name"].split()[0] if recipient["name"] else "colega"
-            html_body  = build_html_email(all_articles, date_str, recipient["name"])
- 
-            msg = MIMEMultipart("alternative")
-            msg["Subject"] = subject
-            msg["From"]    = f"Inteligência Regulatória Telecom <{gmail_address}>"
-            msg["To"]      = recipient["email"]
-            msg.attach(MIMEText(html_body, "html"))
- 
-            server.sendmail(gmail_address, [recipient["email"]], msg.as_string())
-            print(f"  [OK] Enviado para {recipient['email']} ({recipient['name']})")
+    send_emails(config["recipients"], all_articles, subject, date_str, GMAIL_ADDRESS, GMAIL_APP_PASSWORD)
  
     # Update seen_urls with all articles sent today
     new_urls_today = {a["link"] for a in all_articles}
     print("A guardar URLs vistos...")
     save_seen_urls(GITHUB_TOKEN, GITHUB_REPO, seen_urls, new_urls_today, seen_sha)
+    save_json_state(GITHUB_TOKEN, GITHUB_REPO, FEED_CACHE_FILE, feed_cache, feed_cache_sha)
+    save_json_state(GITHUB_TOKEN, GITHUB_REPO, SUMMARY_CACHE_FILE, summary_cache, summary_cache_sha)
  
     print("Concluído! ✓")
  